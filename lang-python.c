@@ -13,6 +13,7 @@
 #include <errno.h>
 
 #include <libjvs/list.h>
+#include <libjvs/buffer.h>
 #include <libjvs/utils.h>
 
 #include "switches.h"
@@ -25,6 +26,7 @@ static int do_unpack = 0;
 static int do_recv = 0;
 static int do_mx_send = 0;
 static int do_mx_bcast = 0;
+static int do_lazy_str = 0;
 
 static Switch switches[] = {
     { "--py-pack",     &do_pack,     "Generate pack functions" },
@@ -32,6 +34,7 @@ static Switch switches[] = {
     { "--py-recv",     &do_recv,     "Generate recv functions" },
     { "--py-mx-send",  &do_mx_send,  "Generate MX send functions" },
     { "--py-mx-bcast", &do_mx_bcast, "Generate MX broadcast functions" },
+    { "--py-lazy-str", &do_lazy_str, "Decode unpacked strings on first use" },
 };
 
 static int num_switches = sizeof(switches) / sizeof(switches[0]);
@@ -57,7 +60,7 @@ static const char *interface_type(Definition *def)
     case DT_ASTRING:
         return "str";
     case DT_USTRING:
-        return "unicode";
+        return "str";
     case DT_ARRAY:
         return "list";
     case DT_ALIAS:
@@ -71,6 +74,251 @@ static const char *interface_type(Definition *def)
     }
 }
 
+/*
+ * Return the extra arguments to pass when unpacking a value of type <def>.
+ */
+static const char *unpack_args(Definition *def)
+{
+    if (do_lazy_str && is_string_type(def)) {
+        return ", lazy = True";
+    }
+    else {
+        return "";
+    }
+}
+
+/*
+ * If values of type <def> always have the same size and consist only of
+ * integers and floats, add the struct module format characters that describe
+ * them to <fmt>, add their size to <size> and return TRUE. Otherwise return
+ * FALSE.
+ */
+static int fixed_layout(Definition *def, Buffer *fmt, int *size)
+{
+    /* Indexed by signedness and (size - 1). */
+    static const char *int_formats[2] = { "BH?I???Q", "bh?i???q" };
+
+    StructItem *item;
+
+    switch(def->type) {
+    case DT_INT:
+        bufAddC(fmt, int_formats[def->int_def.is_signed][def->int_def.size - 1]);
+        *size += def->int_def.size;
+        return TRUE;
+    case DT_FLOAT:
+        bufAddC(fmt, def->float_def.size == 4 ? 'f' : 'd');
+        *size += def->float_def.size;
+        return TRUE;
+    case DT_ENUM:
+        bufAddC(fmt, 'I');
+        *size += 4;
+        return TRUE;
+    case DT_ALIAS:
+        return fixed_layout(def->alias_def.alias, fmt, size);
+    case DT_STRUCT:
+        for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
+            if (!fixed_layout(item->def, fmt, size)) return FALSE;
+        }
+        return TRUE;
+    default:
+        return FALSE;
+    }
+}
+
+/*
+ * Emit an expression that rebuilds a value of fixed-layout type <def> from the
+ * tuple <items> returned by struct.unpack, starting at element *index, counted
+ * from <start> if that isn't NULL. *index is advanced past the elements that
+ * were used.
+ */
+static void emit_fixed_value(FILE *fp, Definition *def, const char *start, int *index)
+{
+    StructItem *item;
+
+    if (def->type == DT_ALIAS) {
+        emit_fixed_value(fp, def->alias_def.alias, start, index);
+    }
+    else if (def->type == DT_STRUCT) {
+        fprintf(fp, "%s(", def->name);
+
+        for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
+            emit_fixed_value(fp, item->def, start, index);
+
+            if (listNext(item) != NULL) fprintf(fp, ", ");
+        }
+
+        fprintf(fp, ")");
+    }
+    else if (start == NULL) {
+        fprintf(fp, "items[%d]", *index);
+        (*index)++;
+    }
+    else if (*index == 0) {
+        fprintf(fp, "items[%s]", start);
+        (*index)++;
+    }
+    else {
+        fprintf(fp, "items[%s + %d]", start, *index);
+        (*index)++;
+    }
+}
+
+/*
+ * Emit the comma-separated list of all integers and floats in <value>, which
+ * is of fixed-layout type <def>, in the order they are packed. *count is the
+ * number of fields emitted so far, and is advanced past the ones emitted here.
+ */
+static void emit_fixed_fields(FILE *fp, Definition *def, const char *value, int *count)
+{
+    StructItem *item;
+
+    if (def->type == DT_ALIAS) {
+        emit_fixed_fields(fp, def->alias_def.alias, value, count);
+    }
+    else if (def->type == DT_STRUCT) {
+        for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
+            char field[strlen(value) + strlen(item->name) + 2];
+
+            sprintf(field, "%s.%s", value, item->name);
+
+            emit_fixed_fields(fp, item->def, field, count);
+        }
+    }
+    else {
+        fprintf(fp, "%s%s", *count > 0 ? ", " : "", value);
+        (*count)++;
+    }
+}
+
+/*
+ * Emit the struct module format for <count> items with format <fmt>, or for a
+ * single item if <count> is NULL.
+ */
+static void emit_format(FILE *fp, Buffer *fmt, const char *count)
+{
+    const char *p, *f = bufGet(fmt);
+
+    for (p = f; *p == *f; p++);
+
+    if (count == NULL && *p == '\0' && bufLen(fmt) > 1) {
+        fprintf(fp, "'>%zu%c'", bufLen(fmt), *f);
+    }
+    else if (count == NULL) {
+        fprintf(fp, "'>%s'", f);
+    }
+    else if (*p == '\0' && bufLen(fmt) == 1) {
+        fprintf(fp, "'>%%d%c' %% %s", *f, count);
+    }
+    else if (*p == '\0') {
+        fprintf(fp, "'>%%d%c' %% (%zu * %s)", *f, bufLen(fmt), count);
+    }
+    else {
+        fprintf(fp, "'>' + %s * '%s'", count, f);
+    }
+}
+
+/*
+ * Return the numpy dtype for a struct module format made up of one or more
+ * <fmt> characters, or NULL if there isn't one.
+ */
+static const char *numpy_dtype(const char *fmt)
+{
+    static const char *formats = "bBhHiIqQfd";
+    static const char *dtypes[] = {
+        "i1", "u1", "i2", "u2", "i4", "u4", "i8", "u8", "f4", "f8"
+    };
+
+    const char *p, *f;
+
+    for (p = fmt; *p == *fmt; p++);
+
+    if (*fmt == '\0' || *p != '\0' || (f = strchr(formats, *fmt)) == NULL) {
+        return NULL;
+    }
+
+    return dtypes[f - formats];
+}
+
+/*
+ * Emit the statement that turns the tuple <items>, containing the unpacked
+ * fields of <count> items of type <item_type>, into the list <value>.
+ */
+static void emit_array_items(FILE *fp, Definition *item_type, Buffer *fmt)
+{
+    int index = 0;
+
+    Definition *def = item_type;
+
+    while (def->type == DT_ALIAS) def = def->alias_def.alias;
+
+    if (def->type == DT_INT || def->type == DT_FLOAT || def->type == DT_ENUM) {
+        ifprintf(fp, 2, "value = list(items)\n\n");
+    }
+    else if (bufLen(fmt) == 1) {
+        ifprintf(fp, 2, "value = [ ");
+        emit_fixed_value(fp, item_type, "i", &index);
+        fprintf(fp, " for i in range(count) ]\n\n");
+    }
+    else {
+        ifprintf(fp, 2, "value = [ ");
+        emit_fixed_value(fp, item_type, "i", &index);
+        fprintf(fp, " for i in range(0, %d * count, %d) ]\n\n", index, index);
+    }
+}
+
+/*
+ * Emit code that sets <enc> to a tuple containing string field <item> of
+ * <value>, an instance of struct <def>, and its encoded form. Struct classes
+ * cache this tuple in a "_<field>_encoded" slot, so that sizeof and pack_into,
+ * and repeated packing of the same object, encode each string only once.
+ * Strings are immutable, so the cached encoding is valid for as long as the
+ * field still refers to the same string. Packers also accept other objects
+ * with the same fields; those are left untouched, and their strings are simply
+ * encoded every time.
+ */
+static void emit_encoded_field(FILE *fp, Definition *def, StructItem *item)
+{
+    ifprintf(fp, 2, "if isinstance(value, %s):\n", def->name);
+    ifprintf(fp, 3, "enc = value._%s_encoded\n", item->name);
+    ifprintf(fp, 3, "if enc is None or enc[0] is not value.%s:\n", item->name);
+    ifprintf(fp, 4, "enc = value._%s_encoded = (value.%s, %sPacker.encode(value.%s))\n",
+            item->name, item->name, item->def->name, item->name);
+    ifprintf(fp, 2, "else:\n");
+    ifprintf(fp, 3, "enc = (value.%s, %sPacker.encode(value.%s))\n",
+            item->name, item->def->name, item->name);
+}
+
+/*
+ * Emit a class attribute "_<method>_by_tag" for union <def>: a dict that maps
+ * each discriminator value to the <method> of the packer for the corresponding
+ * field. Void fields are left out; the generated code falls back to voidPacker
+ * for those and for unknown discriminator values. If <args> is not empty, and
+ * a field needs extra arguments to <method>, a lambda accepting <args> that
+ * passes them on is emitted instead.
+ */
+static void emit_union_table(FILE *fp, Definition *def, const char *method, const char *args)
+{
+    UnionItem *item;
+
+    ifprintf(fp, 1, "_%s_by_tag = {\n", method);
+
+    for (item = listHead(&def->union_def.items); item; item = listNext(item)) {
+        if (is_void_type(item->def)) continue;
+
+        ifprintf(fp, 2, "%s.%s: ", def->union_def.discr_def->name, item->value);
+
+        if (args[0] != '\0' && unpack_args(item->def)[0] != '\0') {
+            fprintf(fp, "lambda %s: %sPacker.%s(%s%s),\n",
+                    args, item->def->name, method, args, unpack_args(item->def));
+        }
+        else {
+            fprintf(fp, "%sPacker.%s,\n", item->def->name, method);
+        }
+    }
+
+    ifprintf(fp, 1, "}\n\n");
+}
+
 static void emit_class(FILE *fp, Definition *def)
 {
     if (def->type == DT_STRUCT) {
@@ -78,6 +326,21 @@ static void emit_class(FILE *fp, Definition *def)
 
         ifprintf(fp, 0, "class %s(object):\n", def->name);
 
+        int slots = 0;
+
+        ifprintf(fp, 1, "__slots__ = (");
+
+        for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
+            fprintf(fp, "%s'%s'", slots++ > 0 ? ", " : "", item->name);
+
+            if (is_string_type(item->def)) {
+                fprintf(fp, ", '_%s_encoded'", item->name);
+                slots++;
+            }
+        }
+
+        fprintf(fp, "%s)\n\n", slots == 1 ? "," : "");
+
         if (!listIsEmpty(&def->struct_def.items)) {
             ifprintf(fp, 1, "def __init__(self");
 
@@ -91,6 +354,12 @@ static void emit_class(FILE *fp, Definition *def)
                 ifprintf(fp, 2, "self.%s = %s\n", item->name, item->name);
             }
 
+            for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
+                if (is_string_type(item->def)) {
+                    ifprintf(fp, 2, "self._%s_encoded = None\n", item->name);
+                }
+            }
+
             fprintf(fp, "\n");
         }
 
@@ -129,6 +398,8 @@ static void emit_class(FILE *fp, Definition *def)
 
         ifprintf(fp, 0, "class %s(object):\n", def->name);
 
+        ifprintf(fp, 1, "__slots__ = ('%s', 'u')\n\n", def->union_def.discr_name);
+
         ifprintf(fp, 1, "def __init__(self, %s = None, u = None):\n",
                 def->union_def.discr_name);
 
@@ -169,31 +440,82 @@ static void emit_packer(FILE *fp, Definition *def)
         ifprintf(fp, 1, "pass\n\n");
     }
     else if (def->type == DT_ARRAY) {
-        ifprintf(fp, 0, "class %sPacker(object):\n", def->name);
+        Buffer fmt = { 0 };
+        int size = 0;
+
+        int fixed = fixed_layout(def->array_def.item_type, &fmt, &size) &&
+                    bufLen(&fmt) > 0;
+
+        ifprintf(fp, 0, "class %sPacker(Packer):\n", def->name);
+
+        if (do_pack && fixed) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def sizeof(value):\n");
+            ifprintf(fp, 2, "count = len(value)\n\n");
+            ifprintf(fp, 2, "return uint32Packer.sizeof(count) + %d * count\n\n", size);
+        }
+        else if (do_pack) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def sizeof(value):\n");
+            ifprintf(fp, 2, "count = len(value)\n\n");
+            ifprintf(fp, 2, "size = uint32Packer.sizeof(count)\n\n");
+            ifprintf(fp, 2, "for i in range(count):\n");
+            ifprintf(fp, 3, "size += %sPacker.sizeof(value[i])\n\n",
+                    def->array_def.item_type->name);
+            ifprintf(fp, 2, "return size\n\n");
+        }
 
         if (do_pack) {
             ifprintf(fp, 1, "@staticmethod\n");
-            ifprintf(fp, 1, "def pack(value):\n");
+            ifprintf(fp, 1, "def pack_into(writer, value):\n");
             ifprintf(fp, 2, "count = len(value)\n\n");
-            ifprintf(fp, 2, "buf = uint32Packer.pack(count)\n\n");
+            ifprintf(fp, 2, "uint32Packer.pack_into(writer, count)\n\n");
             ifprintf(fp, 2, "for i in range(count):\n");
-            ifprintf(fp, 3, "buf += %sPacker.pack(value[i])\n\n",
+            ifprintf(fp, 3, "%sPacker.pack_into(writer, value[i])\n\n",
                     def->array_def.item_type->name);
-            ifprintf(fp, 2, "return buf\n\n");
         }
 
-        if (do_unpack) {
+        if (do_unpack && fixed) {
             ifprintf(fp, 1, "@staticmethod\n");
-            ifprintf(fp, 1, "def unpack(buf, offset = 0):\n");
-            ifprintf(fp, 2, "count, offset = uint32Packer.unpack(buf, offset)\n\n");
+            ifprintf(fp, 1, "def unpack_view(view, offset):\n");
+            ifprintf(fp, 2, "count, offset = uint32Packer.unpack_view(view, offset)\n\n");
+            ifprintf(fp, 2, "items = struct.unpack_from(");
+            emit_format(fp, &fmt, "count");
+            fprintf(fp, ", view, offset)\n\n");
+            emit_array_items(fp, def->array_def.item_type, &fmt);
+            ifprintf(fp, 2, "return value, offset + %d * count\n\n", size);
+
+            if (numpy_dtype(bufGet(&fmt)) != NULL) {
+                ifprintf(fp, 1, "@staticmethod\n");
+                ifprintf(fp, 1, "def unpack_ndarray(buf, offset = 0):\n");
+                ifprintf(fp, 2, "count, offset = uint32Packer.unpack(buf, offset)\n\n");
+                ifprintf(fp, 2, "return ndarray_from_buffer(buf, offset, '>%s', count, %zu)\n\n",
+                        numpy_dtype(bufGet(&fmt)), bufLen(&fmt));
+            }
+        }
+        else if (do_unpack) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def unpack_view(view, offset):\n");
+            ifprintf(fp, 2, "count, offset = uint32Packer.unpack_view(view, offset)\n\n");
             ifprintf(fp, 2, "value = count * [ None ]\n\n");
             ifprintf(fp, 2, "for i in range(count):\n");
-            ifprintf(fp, 3, "value[i], offset = %sPacker.unpack(buf, offset)\n\n",
-                    def->array_def.item_type->name);
+            ifprintf(fp, 3, "value[i], offset = %sPacker.unpack_view(view, offset%s)\n\n",
+                    def->array_def.item_type->name,
+                    unpack_args(def->array_def.item_type));
             ifprintf(fp, 2, "return value, offset\n\n");
         }
 
-        if (do_recv) {
+        if (do_recv && fixed) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def recv(sock):\n");
+            ifprintf(fp, 2, "count = uint32Packer.recv(sock)\n\n");
+            ifprintf(fp, 2, "items = struct.unpack(");
+            emit_format(fp, &fmt, "count");
+            fprintf(fp, ", recv_all(sock, %d * count))\n\n", size);
+            emit_array_items(fp, def->array_def.item_type, &fmt);
+            ifprintf(fp, 2, "return value\n\n");
+        }
+        else if (do_recv) {
             ifprintf(fp, 1, "@staticmethod\n");
             ifprintf(fp, 1, "def recv(sock):\n");
             ifprintf(fp, 2, "count = uint32Packer.recv(sock)\n\n");
@@ -203,44 +525,127 @@ static void emit_packer(FILE *fp, Definition *def)
                     def->array_def.item_type->name);
             ifprintf(fp, 2, "return value\n\n");
         }
+
+        bufReset(&fmt);
     }
     else if (def->type == DT_STRUCT) {
         StructItem *item;
 
-        ifprintf(fp, 0, "class %sPacker(object):\n", def->name);
+        Buffer fmt = { 0 };
+        int size = 0, index = 0;
 
-        if (do_pack) {
+        int fixed = fixed_layout(def, &fmt, &size) && bufLen(&fmt) > 0;
+
+        ifprintf(fp, 0, "class %sPacker(Packer):\n", def->name);
+
+        if (fixed) {
+            ifprintf(fp, 1, "_struct = struct.Struct(");
+            emit_format(fp, &fmt, NULL);
+            fprintf(fp, ")\n\n");
+        }
+
+        if (do_pack && fixed) {
             ifprintf(fp, 1, "@staticmethod\n");
             ifprintf(fp, 1, "def pack(value):\n");
+            ifprintf(fp, 2, "return %sPacker._struct.pack(", def->name);
+            index = 0;
+            emit_fixed_fields(fp, def, "value", &index);
+            fprintf(fp, ")\n\n");
+
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def sizeof(value):\n");
+            ifprintf(fp, 2, "return %d\n\n", size);
+
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def pack_into(writer, value):\n");
+            ifprintf(fp, 2, "%sPacker._struct.pack_into(writer.buf, writer.offset, ", def->name);
+            index = 0;
+            emit_fixed_fields(fp, def, "value", &index);
+            fprintf(fp, ")\n\n");
+            ifprintf(fp, 2, "writer.offset += %d\n\n", size);
+        }
+        else if (do_pack) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def sizeof(value):\n");
 
-            ifprintf(fp, 2, "buf = b''\n\n");
+            ifprintf(fp, 2, "size = 0\n\n");
 
             for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
-                ifprintf(fp, 2, "buf += %sPacker.pack(value.%s)%s",
-                        item->def->name,
-                        item->name,
-                        listNext(item) == NULL ? "\n\n" : "\n");
+                if (is_string_type(item->def)) {
+                    emit_encoded_field(fp, def, item);
+                    ifprintf(fp, 2, "size += %sPacker.sizeof_encoded(enc[1])%s",
+                            item->def->name,
+                            listNext(item) == NULL ? "\n\n" : "\n");
+                }
+                else {
+                    ifprintf(fp, 2, "size += %sPacker.sizeof(value.%s)%s",
+                            item->def->name,
+                            item->name,
+                            listNext(item) == NULL ? "\n\n" : "\n");
+                }
             }
 
-            ifprintf(fp, 2, "return buf\n\n");
+            ifprintf(fp, 2, "return size\n\n");
+
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def pack_into(writer, value):\n");
+
+            if (listIsEmpty(&def->struct_def.items)) {
+                ifprintf(fp, 2, "pass\n\n");
+            }
+
+            for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
+                if (is_string_type(item->def)) {
+                    emit_encoded_field(fp, def, item);
+                    ifprintf(fp, 2, "%sPacker.pack_encoded_into(writer, enc[1])%s",
+                            item->def->name,
+                            listNext(item) == NULL ? "\n\n" : "\n");
+                }
+                else {
+                    ifprintf(fp, 2, "%sPacker.pack_into(writer, value.%s)%s",
+                            item->def->name,
+                            item->name,
+                            listNext(item) == NULL ? "\n\n" : "\n");
+                }
+            }
         }
 
-        if (do_unpack) {
+        if (do_unpack && fixed) {
             ifprintf(fp, 1, "@staticmethod\n");
-            ifprintf(fp, 1, "def unpack(buf, offset = 0):\n");
+            ifprintf(fp, 1, "def unpack_view(view, offset):\n");
+            ifprintf(fp, 2, "items = %sPacker._struct.unpack_from(view, offset)\n\n",
+                    def->name);
+            ifprintf(fp, 2, "return ");
+            index = 0;
+            emit_fixed_value(fp, def, NULL, &index);
+            fprintf(fp, ", offset + %d\n\n", size);
+        }
+        else if (do_unpack) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def unpack_view(view, offset):\n");
 
             ifprintf(fp, 2, "value = %s()\n\n", def->name);
 
             for (item = listHead(&def->struct_def.items); item; item = listNext(item)) {
-                ifprintf(fp, 2, "value.%s, offset = %sPacker.unpack(buf, offset)%s",
-                        item->name, item->def->name,
+                ifprintf(fp, 2, "value.%s, offset = %sPacker.unpack_view(view, offset%s)%s",
+                        item->name, item->def->name, unpack_args(item->def),
                         listNext(item) == NULL ? "\n\n" : "\n");
             }
 
             ifprintf(fp, 2, "return value, offset\n\n");
         }
 
-        if (do_recv) {
+        if (do_recv && fixed) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def recv(sock):\n");
+            ifprintf(fp, 2, "items = %sPacker._struct.unpack(recv_all(sock, %d))\n\n",
+                    def->name, size);
+            ifprintf(fp, 2, "return ");
+            index = 0;
+            emit_fixed_value(fp, def, NULL, &index);
+            fprintf(fp, "\n\n");
+        }
+        else if (do_recv) {
             ifprintf(fp, 1, "@staticmethod\n");
             ifprintf(fp, 1, "def recv(sock):\n");
 
@@ -254,69 +659,56 @@ static void emit_packer(FILE *fp, Definition *def)
 
             ifprintf(fp, 2, "return value\n\n");
         }
+
+        bufReset(&fmt);
     }
     else if (def->type == DT_ENUM) {
         ifprintf(fp, 0, "class %sPacker(uint32Packer):\n", def->name);
         ifprintf(fp, 1, "pass\n\n");
     }
     else if (def->type == DT_UNION) {
-        UnionItem *item;
+        const char *discr = def->union_def.discr_name;
 
-        ifprintf(fp, 0, "class %sPacker(object):\n", def->name);
+        ifprintf(fp, 0, "class %sPacker(Packer):\n", def->name);
 
         if (do_pack) {
-            ifprintf(fp, 1, "@staticmethod\n");
-            ifprintf(fp, 1, "def pack(value):\n");
+            emit_union_table(fp, def, "sizeof", "");
+            emit_union_table(fp, def, "pack_into", "");
+        }
 
-            ifprintf(fp, 2, "buf = uint32Packer.pack(value.%s)\n\n",
-                    def->union_def.discr_name);
+        if (do_unpack) {
+            emit_union_table(fp, def, "unpack_view", "view, offset");
+        }
 
-            for (item = listHead(&def->union_def.items); item; item = listNext(item)) {
-                ifprintf(fp, 2, "%s value.%s == %s.%s:\n",
-                        item == listHead(&def->union_def.items) ? "if" : "elif",
-                        def->union_def.discr_name,
-                        def->union_def.discr_def->name,
-                        item->value);
+        if (do_recv) {
+            emit_union_table(fp, def, "recv", "");
+        }
 
-                if (is_void_type(item->def)) {
-                    ifprintf(fp, 3, "pass\n");
-                }
-                else {
-                    ifprintf(fp, 3, "buf += %sPacker.pack(value.u)\n", item->def->name);
-                }
-            }
+        if (do_pack) {
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def sizeof(value):\n");
+
+            ifprintf(fp, 2, "size = uint32Packer.sizeof(value.%s)\n\n", discr);
+            ifprintf(fp, 2, "size += %sPacker._sizeof_by_tag.get(value.%s, voidPacker.sizeof)(value.u)\n\n",
+                    def->name, discr);
+            ifprintf(fp, 2, "return size\n\n");
 
-            ifprintf(fp, 0, "\n");
+            ifprintf(fp, 1, "@staticmethod\n");
+            ifprintf(fp, 1, "def pack_into(writer, value):\n");
 
-            ifprintf(fp, 2, "return buf\n\n");
+            ifprintf(fp, 2, "uint32Packer.pack_into(writer, value.%s)\n\n", discr);
+            ifprintf(fp, 2, "%sPacker._pack_into_by_tag.get(value.%s, voidPacker.pack_into)(writer, value.u)\n\n",
+                    def->name, discr);
         }
 
         if (do_unpack) {
             ifprintf(fp, 1, "@staticmethod\n");
-            ifprintf(fp, 1, "def unpack(buf, offset = 0):\n");
+            ifprintf(fp, 1, "def unpack_view(view, offset):\n");
 
             ifprintf(fp, 2, "value = %s()\n\n", def->name);
-            ifprintf(fp, 2, "value.%s, offset = uint32Packer.unpack(buf, offset)\n\n",
-                    def->union_def.discr_name);
-
-            for (item = listHead(&def->union_def.items); item; item = listNext(item)) {
-                ifprintf(fp, 2, "%s value.%s == %s.%s:\n",
-                        item == listHead(&def->union_def.items) ? "if" : "elif",
-                        def->union_def.discr_name,
-                        def->union_def.discr_def->name,
-                        item->value);
-
-                if (is_void_type(item->def)) {
-                    ifprintf(fp, 3, "pass\n");
-                }
-                else {
-                    ifprintf(fp, 3, "value.u, offset = %sPacker.unpack(buf, offset)\n",
-                            item->def->name);
-                }
-            }
-
-            ifprintf(fp, 0, "\n");
-
+            ifprintf(fp, 2, "value.%s, offset = uint32Packer.unpack_view(view, offset)\n\n", discr);
+            ifprintf(fp, 2, "value.u, offset = %sPacker._unpack_view_by_tag.get(value.%s, voidPacker.unpack_view)(view, offset)\n\n",
+                    def->name, discr);
             ifprintf(fp, 2, "return value, offset\n\n");
         }
 
@@ -325,27 +717,9 @@ static void emit_packer(FILE *fp, Definition *def)
             ifprintf(fp, 1, "def recv(sock):\n");
 
             ifprintf(fp, 2, "value = %s()\n\n", def->name);
-            ifprintf(fp, 2, "value.%s = uint32Packer.recv(sock)\n\n",
-                    def->union_def.discr_name);
-
-            for (item = listHead(&def->union_def.items); item; item = listNext(item)) {
-                ifprintf(fp, 2, "%s value.%s == %s.%s:\n",
-                        item == listHead(&def->union_def.items) ? "if" : "elif",
-                        def->union_def.discr_name,
-                        def->union_def.discr_def->name,
-                        item->value);
-
-                if (is_void_type(item->def)) {
-                    ifprintf(fp, 3, "pass\n");
-                }
-                else {
-                    ifprintf(fp, 3, "value.u = %sPacker.recv(sock)\n",
-                            item->def->name);
-                }
-            }
-
-            ifprintf(fp, 0, "\n");
-
+            ifprintf(fp, 2, "value.%s = uint32Packer.recv(sock)\n\n", discr);
+            ifprintf(fp, 2, "value.u = %sPacker._recv_by_tag.get(value.%s, voidPacker.recv)(sock)\n\n",
+                    def->name, discr);
             ifprintf(fp, 2, "return value\n\n");
         }
     }
@@ -391,7 +765,7 @@ int emit_python_src(const char *out_file,
         return 1;
     }
 
-    fprintf(fp, "#!/usr/bin/env python\n");
+    fprintf(fp, "#!/usr/bin/env python3\n");
     fprintf(fp, "# -*- coding: utf-8 -*-\n\n");
 
     fprintf(fp, "'''\n");
@@ -399,6 +773,7 @@ int emit_python_src(const char *out_file,
     fprintf(fp, "\n");
     fprintf(fp, "  Generated by %s from \"%s\" on %s", prog_name, in_file, time_str);
     fprintf(fp, "'''\n\n");
+    fprintf(fp, "import struct\n\n");
     fprintf(fp, "from tyger import *\n\n");
 
     for (def = listHead(definitions); def; def = listNext(def)) {
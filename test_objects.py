@@ -12,6 +12,8 @@
   http://www.opensource.org/licenses/mit-license.php for details.
 '''
 
+import struct
+
 from Objects import *
 
 s = Vector(1, 2, 3)
@@ -32,6 +34,16 @@ assert s.x == 10
 assert s.y == 2
 assert s.z == 3
 
+for obj in [ Vector(1, 2, 3), Shape(ShapeType.ST_NONE) ]:
+  try:
+    obj.w = 1
+  except AttributeError:
+    pass
+  else:
+    assert False, "setting an unknown attribute should fail"
+
+assert '_name_encoded' in Object.__slots__
+
 buf = VectorPacker.pack(s)
 
 assert buf == b'\x00\x00\x00\x0a\x00\x00\x00\x02\x00\x00\x00\x03'
@@ -119,3 +131,296 @@ for o in l:
   assert o.shape.u.nv.x == 4
   assert o.shape.u.nv.y == 5
   assert o.shape.u.nv.z == -6
+
+# A socket-like object that returns the given data from recv_into().
+
+class Reader(object):
+  def __init__(self, data):
+    self.data = data
+
+  def recv_into(self, view, size):
+    data, self.data = self.data[:size], self.data[size:]
+
+    view[:len(data)] = data
+
+    return len(data)
+
+s = Shape(ShapeType.ST_POLYGON, [ Vector(1, 1, 0), Vector(-1, 1, 0), Vector(0, 0, 2) ])
+
+buf = ShapePacker.pack(s)
+
+assert buf == b"\x00\x00\x00\x02" \
+            + b"\x00\x00\x00\x03" \
+            + b"\x00\x00\x00\x01\x00\x00\x00\x01\x00\x00\x00\x00" \
+            + b"\xff\xff\xff\xff\x00\x00\x00\x01\x00\x00\x00\x00" \
+            + b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x02"
+
+s, offset = ShapePacker.unpack(buf)
+
+assert offset == 44
+assert s.shape_type == ShapeType.ST_POLYGON
+assert [ (v.x, v.y, v.z) for v in s.u ] == [ (1, 1, 0), (-1, 1, 0), (0, 0, 2) ]
+
+s = ShapePacker.recv(Reader(buf))
+
+assert s.shape_type == ShapeType.ST_POLYGON
+assert [ (v.x, v.y, v.z) for v in s.u ] == [ (1, 1, 0), (-1, 1, 0), (0, 0, 2) ]
+
+import Layouts
+
+buf = Layouts.WrapsPacker.pack([ Layouts.Wrap(1), Layouts.Wrap(2) ])
+
+assert buf == b"\x00\x00\x00\x02\x00\x00\x00\x01\x00\x00\x00\x02"
+
+l, offset = Layouts.WrapsPacker.unpack(buf)
+
+assert offset == 12
+assert [ type(w) for w in l ] == [ Layouts.Wrap, Layouts.Wrap ]
+assert [ w.v for w in l ] == [ 1, 2 ]
+
+l = Layouts.WrapsPacker.recv(Reader(buf))
+
+assert [ type(w) for w in l ] == [ Layouts.Wrap, Layouts.Wrap ]
+assert [ w.v for w in l ] == [ 1, 2 ]
+
+m = Layouts.Mixed(1, Layouts.Empty(), -2)
+
+buf = Layouts.MixedPacker.pack(m)
+
+assert buf == b"\x00\x00\x00\x01\xff\xfe"
+
+for m, offset in [ Layouts.MixedPacker.unpack(buf), (Layouts.MixedPacker.recv(Reader(buf)), 6) ]:
+  assert offset == 6
+  assert m.a == 1
+  assert isinstance(m.e, Layouts.Empty)
+  assert m.b == -2
+
+p = Layouts.Pixel(Layouts.Color.GREEN, 1.5, 255)
+
+buf = Layouts.PixelPacker.pack(p)
+
+assert buf == b"\x00\x00\x00\x02\x3f\xf8\x00\x00\x00\x00\x00\x00\xff"
+
+for p, offset in [ Layouts.PixelPacker.unpack(buf), (Layouts.PixelPacker.recv(Reader(buf)), 13) ]:
+  assert offset == 13
+  assert p.c == Layouts.Color.GREEN
+  assert p.x == 1.5
+  assert p.alpha == 255
+
+l = Layouts.Label('A pixel', p)
+
+buf = Layouts.LabelPacker.pack(l)
+
+assert buf == b"\x00\x00\x00\x07A pixel" + Layouts.PixelPacker.pack(p)
+
+l, offset = Layouts.LabelPacker.unpack(buf)
+
+assert offset == 24
+assert l.text == 'A pixel'
+assert (l.at.c, l.at.x, l.at.alpha) == (Layouts.Color.GREEN, 1.5, 255)
+
+scratch = bytearray()
+
+o = Object('A', U'B', Shape(ShapeType.ST_NONE))
+
+size = ObjectPacker.pack_into_buffer(o, scratch)
+
+assert size == 14
+assert scratch[:size] == ObjectPacker.pack(o)
+
+o = Object('A plane', U'Björn', Shape(ShapeType.ST_PLANE, Plane(Vector(10, 2, 3), Vector(4, 5, -6))))
+
+size = ObjectPacker.pack_into_buffer(o, scratch)
+
+assert size == 49
+assert scratch[:size] == expected
+
+o = Object('A', U'B', Shape(ShapeType.ST_NONE))
+
+size = ObjectPacker.pack_into_buffer(o, scratch)
+
+assert size == 14
+assert len(scratch) == 49
+assert scratch[:size] == ObjectPacker.pack(o)
+
+size = ObjectsPacker.pack_into_buffer(3 * [ o ], scratch)
+
+assert scratch[:size] == ObjectsPacker.pack(3 * [ o ])
+
+assert float32Packer._struct.size == 4
+assert float64Packer._struct.size == 8
+
+assert float32Packer._size == 4
+assert float64Packer._size == 8
+assert ShapeTypePacker._size == 4
+
+assert float32Packer.pack(1.5) == b'\x3f\xc0\x00\x00'
+assert float64Packer.pack(-2.25) == b'\xc0\x02\x00\x00\x00\x00\x00\x00'
+
+assert float32Packer.unpack(b'\x00' + float32Packer.pack(0.5), 1) == (0.5, 5)
+assert float64Packer.unpack(float64Packer.pack(0.1)) == (0.1, 8)
+
+for shape_type in [ ShapeType.ST_NONE, 99 ]:
+  s = Shape(shape_type)
+
+  buf = ShapePacker.pack(s)
+
+  assert buf == struct.pack('>I', shape_type)
+
+  for s, offset in [ ShapePacker.unpack(buf), (ShapePacker.recv(Reader(buf)), 4) ]:
+    assert offset == 4
+    assert s.shape_type == shape_type
+    assert s.u is None
+
+# A socket-like object that only has recv(), and returns at most <chunk> bytes
+# from each call.
+
+class ShortReader(object):
+  def __init__(self, data, chunk = 3):
+    self.data = data
+    self.chunk = chunk
+
+  def recv(self, size):
+    size = min(size, self.chunk)
+
+    data, self.data = self.data[:size], self.data[size:]
+
+    return data
+
+o = ObjectPacker.recv(ShortReader(expected))
+
+assert o.name == 'A plane'
+assert o.creator == U'Björn'
+assert o.shape.u.nv.z == -6
+
+try:
+  ObjectPacker.recv(ShortReader(expected[:15]))
+except Exception as e:
+  assert str(e) == "Lost connection"
+else:
+  assert False, "receiving a truncated object should fail"
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+if numpy is not None:
+  buf = ShapePacker.pack(Shape(ShapeType.ST_POLYGON, [ Vector(1, 1, 0), Vector(-1, 1, 0), Vector(0, 0, 2) ]))
+
+  a, offset = PolygonPacker.unpack_ndarray(buf, 4)
+
+  assert offset == 44
+  assert a.shape == (3, 3)
+  assert a.dtype == numpy.dtype('>i4')
+  assert a.tolist() == [ [ 1, 1, 0 ], [ -1, 1, 0 ], [ 0, 0, 2 ] ]
+
+  a, offset = PolygonPacker.unpack_ndarray(b"\x00\x00\x00\x00")
+
+  assert offset == 4
+  assert a.shape == (0, 3)
+
+  try:
+    PolygonPacker.unpack_ndarray(buf[:40], 4)
+  except ValueError:
+    pass
+  else:
+    assert False, "unpacking a truncated array should fail"
+
+  buf = Layouts.WrapsPacker.pack([ Layouts.Wrap(1), Layouts.Wrap(-2) ])
+
+  a, offset = Layouts.WrapsPacker.unpack_ndarray(buf)
+
+  assert offset == 12
+  assert a.shape == (2,)
+  assert a.dtype == numpy.dtype('>i4')
+  assert a.tolist() == [ 1, -2 ]
+
+import LazyObjects
+
+o, offset = LazyObjects.ObjectPacker.unpack(expected)
+
+assert isinstance(o.name, LazyString)
+assert isinstance(o.creator, LazyString)
+assert o.name == 'A plane'
+assert o.creator == U'Björn'
+assert str(o.creator) == U'Björn'
+assert len(o.creator) == 5
+assert o.shape.u.nv.z == -6
+
+assert offset == 49
+
+assert LazyObjects.ObjectPacker.pack(o) == expected
+assert ObjectPacker.pack(o) == expected
+
+buf = bytearray(expected)
+
+o, offset = LazyObjects.ObjectPacker.unpack(buf)
+
+buf[4:11] = b"XXXXXXX"
+buf.clear()
+
+assert o.name == 'A plane'
+assert o.creator == U'Björn'
+
+o = Object('A plane', U'Björn', Shape(ShapeType.ST_PLANE, Plane(Vector(10, 2, 3), Vector(4, 5, -6))))
+
+assert ObjectPacker.pack(o) == expected
+assert ObjectPacker.pack(o) == expected
+
+o.creator = U'Jürgen'
+
+buf = ObjectPacker.pack(o)
+
+assert buf == b"\x00\x00\x00\x07A plane" + b"\x00\x00\x00\x07J\xc3\xbcrgen" + expected[21:]
+
+o, offset = ObjectPacker.unpack(buf)
+
+assert o.creator == U'Jürgen'
+assert offset == 50
+
+o.name = 'A planet'
+
+assert ObjectPacker.sizeof(o) == 51
+assert ObjectPacker.pack(o)[:12] == b"\x00\x00\x00\x08A planet"
+
+for packer, args in [ (astringPacker, ()), (ustringPacker, ()), (astringPacker, (0, True)) ]:
+  try:
+    packer.unpack(b"\x00\x00\x00\x09abc", *args)
+  except struct.error:
+    pass
+  else:
+    assert False, "unpacking a truncated string should fail"
+
+import array
+
+a = array.array('I')
+a.frombytes(expected + b"\x00\x00\x00")
+
+o, offset = ObjectPacker.unpack(a)
+
+assert offset == 49
+assert o.name == 'A plane'
+assert o.creator == U'Björn'
+assert o.shape.u.nv.z == -6
+
+assert astringPacker.unpack(a) == ('A plane', 11)
+assert ustringPacker.unpack(a, 11) == (U'Björn', 21)
+
+import collections, types
+
+shape = Shape(ShapeType.ST_PLANE, Plane(Vector(10, 2, 3), Vector(4, 5, -6)))
+
+for o in [ types.SimpleNamespace(name = 'A plane', creator = U'Björn', shape = shape),
+           collections.namedtuple('Obj', 'name creator shape')('A plane', U'Björn', shape) ]:
+  assert ObjectPacker.sizeof(o) == 49
+  assert ObjectPacker.pack(o) == expected
+  assert ObjectPacker.pack(o) == expected
+
+o = types.SimpleNamespace(name = 'A plane', creator = U'Björn', shape = shape)
+
+fields = dict(vars(o))
+
+assert ObjectPacker.sizeof(o) == 49
+assert ObjectPacker.pack(o) == expected
+assert vars(o) == fields
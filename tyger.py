@@ -14,39 +14,198 @@
 
 import struct
 
+try:
+  import numpy as _numpy
+except ImportError:
+  _numpy = None
+
+_U32 = struct.Struct('>I')
+
+# Receive exactly <size> bytes from <sock> and return them as bytes. Sockets
+# read straight into a preallocated buffer; other socket-like objects that only
+# have recv() are read in chunks.
+
 def recv_all(sock, size):
-  received = ""
+  received = bytearray(size)
+  view = memoryview(received)
+  count = 0
+
+  if hasattr(sock, 'recv_into'):
+    while count < size:
+      n = sock.recv_into(view[count:], size - count)
+
+      if n == 0:
+        raise Exception("Lost connection")
+      else:
+        count += n
+  else:
+    while count < size:
+      data = sock.recv(size - count)
+
+      if not data:
+        raise Exception("Lost connection")
+      else:
+        view[count:count + len(data)] = data
+        count += len(data)
+
+  return bytes(received)
+
+# Return <count> items of <width> elements of numpy type <dtype> found in <buf>
+# at <offset> as a numpy array (with shape (count, width), or just (count,) if
+# <width> is 1), plus the offset just past them. The array is a view on <buf>,
+# so nothing is copied, and it is read-only if <buf> is. Requires numpy.
+
+def ndarray_from_buffer(buf, offset, dtype, count, width):
+  if _numpy is None:
+    raise ImportError("ndarray_from_buffer requires numpy")
+
+  array = _numpy.frombuffer(buf, dtype, count * width, offset)
+
+  if width > 1:
+    array = array.reshape(count, width)
+
+  return array, offset + array.nbytes
 
-  while len(received) < size:
-    data = sock.recv(size - len(received))
+# A string that is decoded from the buffer it was unpacked from only when it is
+# first used. Until then it keeps that buffer alive. If the buffer is writable
+# the string's bytes are copied instead, so that later changes to the buffer
+# (or growing or shrinking it) don't affect it.
 
-    if data == "":
-      raise Exception("Lost connection")
+class LazyString(object):
+  __slots__ = ('_view', '_encoding', '_value')
+
+  def __init__(self, view, encoding):
+    if not view.readonly:
+      view = memoryview(view.tobytes())
+
+    self._view = view
+    self._encoding = encoding
+    self._value = None
+
+  def decode(self):
+    if self._view is not None:
+      self._value = str(self._view, self._encoding)
+      self._view = None
+
+    return self._value
+
+  def encode(self, encoding):
+    if self._view is not None and encoding == self._encoding:
+      return self._view.tobytes()
     else:
-      received += data
+      return self.decode().encode(encoding)
+
+  def __str__(self):
+    return self.decode()
+
+  def __repr__(self):
+    return repr(self.decode())
+
+  def __len__(self):
+    return len(self.decode())
+
+  def __hash__(self):
+    return hash(self.decode())
+
+  def __eq__(self, other):
+    if isinstance(other, LazyString):
+      other = other.decode()
+
+    return self.decode() == other
+
+# A buffer of <size> bytes that pack_into calls fill in, starting at offset 0.
+# String payloads are copied in through <view>, which is a straight memcpy. If
+# bytearray <buf> is given it is used instead of a new one, after growing it to
+# <size> bytes if it is shorter than that.
 
-  return received
+class Writer(object):
+  __slots__ = ('buf', 'view', 'offset')
 
-class basePacker(object):
+  def __init__(self, size, buf = None):
+    if buf is None:
+      buf = bytearray(size)
+    elif len(buf) < size:
+      buf[len(buf):] = bytearray(size - len(buf))
+
+    self.buf = buf
+    self.view = memoryview(buf)
+    self.offset = 0
+
+# Base class for all packers. Subclasses implement sizeof(value), which
+# returns the number of bytes needed to pack <value>, pack_into(writer, value),
+# which writes the packed form of <value> to <writer> at its current offset,
+# and unpack_view(view, offset), which unpacks a value from memoryview <view>
+# at <offset>. Since slicing a memoryview doesn't copy, unpack wraps its buffer
+# in one once and passes that all the way down. The view is cast to unsigned
+# bytes, so that slices count bytes (as the struct calls do) whatever the item
+# type of the buffer.
+
+class Packer(object):
   @classmethod
   def pack(cls, value):
-    return struct.pack(cls._format, value)
+    writer = Writer(cls.sizeof(value))
+
+    cls.pack_into(writer, value)
+
+    return bytes(writer.buf)
+
+  # Pack <value> into the start of bytearray <scratch>, growing it if necessary,
+  # and return the number of bytes used. Re-using the same scratch buffer for
+  # every message avoids allocating a new one each time.
+
+  @classmethod
+  def pack_into_buffer(cls, value, scratch):
+    size = cls.sizeof(value)
+
+    writer = Writer(size, scratch)
+
+    cls.pack_into(writer, value)
+
+    return size
 
   @classmethod
   def unpack(cls, buf, offset = 0):
-    size = struct.calcsize(cls._format)
+    return cls.unpack_view(memoryview(buf).cast('B'), offset)
+
+# Base class for the packers of scalar types. Subclasses set _format to the
+# struct format of their type, from which _struct (the compiled format) and
+# _size (its size in bytes) are derived once, when the subclass is defined.
 
-    value, = struct.unpack(cls._format, buf[offset:offset + size])
+class basePacker(Packer):
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
 
-    return value, offset + size
+    if '_format' in cls.__dict__:
+      cls._struct = struct.Struct(cls._format)
+      cls._size = cls._struct.size
 
   @classmethod
-  def recv(cls, sock):
-    size = struct.calcsize(cls._format)
+  def pack(cls, value):
+    return cls._struct.pack(value)
+
+  @classmethod
+  def sizeof(cls, value):
+    return cls._size
+
+  @classmethod
+  def pack_into(cls, writer, value):
+    cls._struct.pack_into(writer.buf, writer.offset, value)
+
+    writer.offset += cls._size
+
+  @classmethod
+  def unpack(cls, buf, offset = 0):
+    value, = cls._struct.unpack_from(buf, offset)
+
+    return value, offset + cls._size
 
-    data = recv_all(sock, size)
+  unpack_view = unpack
 
-    value, = struct.unpack(cls._format, data)
+  @classmethod
+  def recv(cls, sock):
+    data = recv_all(sock, cls._size)
+
+    value, = cls._struct.unpack(data)
 
     return value
 
@@ -80,20 +239,84 @@ class float32Packer(basePacker):
 class float64Packer(basePacker):
   _format = '>d'
 
-class astringPacker(object):
+# Packer for the void fields of a union. These take up no space, and unpack as
+# None.
+
+class voidPacker(Packer):
+  @staticmethod
+  def sizeof(value):
+    return 0
+
+  @staticmethod
+  def pack_into(writer, value):
+    pass
+
+  @staticmethod
+  def unpack_view(view, offset):
+    return None, offset
+
+  @staticmethod
+  def recv(sock):
+    return None
+
+# The string packers also have encode(value), which returns the bytes that
+# <value> is packed as, plus sizeof_encoded(data) and pack_encoded_into(writer,
+# data), which work on such bytes. Generated struct packers use these to
+# encode each string field only once, and cache the result on the object.
+# Their unpack_view raises struct.error if <view> ends before the string does,
+# as the struct calls do for scalars.
+
+class astringPacker(Packer):
   @staticmethod
   def pack(value):
     asc = value.encode('ascii')
 
-    return struct.pack(">I", len(asc)) + asc
+    return _U32.pack(len(asc)) + asc
+
+  @staticmethod
+  def sizeof(value):
+    return _U32.size + len(value)
+
+  @staticmethod
+  def pack_into(writer, value):
+    astringPacker.pack_encoded_into(writer, value.encode('ascii'))
+
+  @staticmethod
+  def encode(value):
+    return value.encode('ascii')
+
+  @staticmethod
+  def sizeof_encoded(data):
+    return _U32.size + len(data)
 
   @staticmethod
-  def unpack(buf, offset = 0):
-    length, offset = uint32Packer.unpack(buf, offset)
+  def pack_encoded_into(writer, data):
+    _U32.pack_into(writer.buf, writer.offset, len(data))
+
+    start = writer.offset + _U32.size
+    writer.offset = start + len(data)
 
-    asc = buf[offset:offset + length]
+    writer.view[start:writer.offset] = data
 
-    return asc.decode('ascii'), offset + length
+  @staticmethod
+  def unpack(buf, offset = 0, lazy = False):
+    return astringPacker.unpack_view(memoryview(buf).cast('B'), offset, lazy)
+
+  @staticmethod
+  def unpack_view(view, offset, lazy = False):
+    length, = _U32.unpack_from(view, offset)
+    offset += _U32.size
+
+    if offset + length > view.nbytes:
+      raise struct.error("unpacking a string requires a buffer of at least %d bytes" %
+          (offset + length))
+
+    asc = view[offset:offset + length]
+
+    if lazy:
+      return LazyString(asc, 'ascii'), offset + length
+    else:
+      return str(asc, 'ascii'), offset + length
 
   @staticmethod
   def recv(sock):
@@ -101,22 +324,59 @@ class astringPacker(object):
 
     data = recv_all(sock, length)
 
-    return str(data)
+    return data.decode('ascii')
 
-class ustringPacker(object):
+class ustringPacker(Packer):
   @staticmethod
   def pack(value):
     utf8 = value.encode('utf-8')
 
-    return struct.pack(">I", len(utf8)) + utf8
+    return _U32.pack(len(utf8)) + utf8
 
   @staticmethod
-  def unpack(buf, offset = 0):
-    length, offset = uint32Packer.unpack(buf, offset)
+  def sizeof(value):
+    return _U32.size + len(value.encode('utf-8'))
 
-    utf8 = buf[offset:offset + length]
+  @staticmethod
+  def pack_into(writer, value):
+    ustringPacker.pack_encoded_into(writer, value.encode('utf-8'))
+
+  @staticmethod
+  def encode(value):
+    return value.encode('utf-8')
 
-    return utf8.decode('utf-8'), offset + length
+  @staticmethod
+  def sizeof_encoded(data):
+    return _U32.size + len(data)
+
+  @staticmethod
+  def pack_encoded_into(writer, data):
+    _U32.pack_into(writer.buf, writer.offset, len(data))
+
+    start = writer.offset + _U32.size
+    writer.offset = start + len(data)
+
+    writer.view[start:writer.offset] = data
+
+  @staticmethod
+  def unpack(buf, offset = 0, lazy = False):
+    return ustringPacker.unpack_view(memoryview(buf).cast('B'), offset, lazy)
+
+  @staticmethod
+  def unpack_view(view, offset, lazy = False):
+    length, = _U32.unpack_from(view, offset)
+    offset += _U32.size
+
+    if offset + length > view.nbytes:
+      raise struct.error("unpacking a string requires a buffer of at least %d bytes" %
+          (offset + length))
+
+    utf8 = view[offset:offset + length]
+
+    if lazy:
+      return LazyString(utf8, 'utf-8'), offset + length
+    else:
+      return str(utf8, 'utf-8'), offset + length
 
   @staticmethod
   def recv(sock):
@@ -136,7 +396,7 @@ if __name__ == '__main__':
   s, offset = astringPacker.unpack(buf)
   print("unpacked: s =", s, ", offset =", offset)
 
-  s = U"αß¢"
+  s = "αß¢"
   print("s = %s" % s)
 
   buf = ustringPacker.pack(s)
@@ -144,3 +404,6 @@ if __name__ == '__main__':
 
   s, offset = ustringPacker.unpack(buf)
   print("unpacked: s =", s, ", offset =", offset)
+
+  s, offset = ustringPacker.unpack(buf, lazy = True)
+  print("unpacked lazily: s =", s, ", offset =", offset)
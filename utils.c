@@ -50,6 +50,22 @@ int is_integer_type(Definition *def)
     }
 }
 
+/*
+ * Find out whether <def> defines a string type.
+ */
+int is_string_type(Definition *def)
+{
+    if (def->type == DT_ASTRING || def->type == DT_USTRING) {
+        return TRUE;
+    }
+    else if (def->type == DT_ALIAS) {
+        return is_string_type(def->alias_def.alias);
+    }
+    else {
+        return FALSE;
+    }
+}
+
 /*
  * Find out whether <def> defines a void type.
  */
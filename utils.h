@@ -21,6 +21,11 @@ const char *time_as_string(void);
  */
 int is_integer_type(Definition *def);
 
+/*
+ * Find out whether <def> defines a string type.
+ */
+int is_string_type(Definition *def);
+
 /*
  * Find out whether <def> defines a void type.
  */